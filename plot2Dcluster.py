@@ -31,60 +31,314 @@ Copyright (c) 2016 Zhen Zhu
 """
 
 import matplotlib.pyplot as plt
-from matplotlib import colors
-import random as rd
 import numpy as np
-import colorsys as cs
-import operator
+from functools import lru_cache
+import hashlib
 
+try: # numba is optional; it speeds up the majority rule on large arrays.
+    import numba
+except ImportError:
+    numba = None
 
-def plot_com_original(com_data,rownames,colnames):
+# Below this value of codes.size*n_com the numpy majority rule is fast enough, and
+# compiling the numba kernel would take longer than it saves.
+_NUMBA_MIN_WORK = 10**9
+
+# Largest number of counts held at once by the numpy majority rule. The rows are counted
+# in chunks of at most _COUNT_BUDGET//n_com rows, so that memory does not grow with n_com.
+_COUNT_BUDGET = 2**22
+
+
+def _rank_communities(com_data):
     """
-    This function returns a plot of the community array as it is. The parameters
-    include:
-    com_data: A 2-dimension community array. 
-    rownames: A list of strings corresponding to the row names of com_data.
-    colnames: A list of strings corresponding to the column names of com_data.
+    This function ranks the communities of com_data by frequency. It returns:
+    labels: The sorted distinct communities. The community labels[c] is
+    given the code c.
+    rank: An array where rank[c] is the position of the community with code c
+    in the ranking list (0 being the most frequent).
     """
-    # Get the basic info of the community array.
-    com_data = com_data.astype(int) # Make sure that the communities are denoted as integers.
-    n_row = np.shape(com_data)[0] # Number of rows.
-    n_col = np.shape(com_data)[1] # Number of columns.
-    data = com_data.reshape(com_data.size) # Convert to 1-dimension array.
-    all_count = np.bincount(data) # Count frequency of each community.
-    all_order = np.argsort(all_count)[::-1] # Generate the ranking list of communities by frequency.
-    n_com = len(all_order) # n_com is equal to the largest integer in com_data plus 1.
+    labels, all_count = np.unique(com_data, return_counts=True) # Count frequency of each community.
+    all_order = np.argsort(-all_count, kind='stable') # Generate the ranking list of communities by frequency.
+    rank = np.empty(len(labels), dtype=int)
+    rank[all_order] = np.arange(len(labels)) # Position of each community in the ranking list.
+    return labels, rank
+
+
+def _count_matrix(com_data,n_com):
+    """
+    This function returns an (n_row, n_com) array whose element (i,j) is the
+    number of times community j appears in row i of com_data. All the rows are
+    counted by a single np.bincount over row-offset community labels.
+    """
+    n_row = com_data.shape[0] # Number of rows.
+    flat = com_data + np.arange(n_row)[:,None]*n_com # Shift row i into the range [i*n_com, (i+1)*n_com).
+    counts = np.bincount(flat.ravel(), minlength=n_row*n_com)
+    return counts.reshape(n_row,n_com)
+
+
+def _priority_order(coms,vals,rank):
+    """
+    This function returns the order of the (majority community, frequency)
+    pairs coms and vals: by the ranking of the community first, then by
+    decreasing frequency, and by position when both are tied. The two keys are
+    packed into one integer, so that a single stable argsort does the work.
+    """
+    top = vals.max() # No frequency is larger than this.
+    key = rank[coms]*(top+1) + (top-vals)
+    return np.argsort(key, kind='stable')
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _row_majority(codes,rank,n_com):
+        """
+        This function returns, for each row of the array of community codes,
+        its majority community and the frequency of that community. When
+        several communities are tied, the one ranking highest is returned.
+        The rows are processed in parallel, each with its own counts.
+        """
+        n_row = codes.shape[0]
+        out_com = np.empty(n_row, np.int64)
+        out_cnt = np.empty(n_row, np.int64)
+        for i in numba.prange(n_row):
+            counts = np.zeros(n_com, np.int64)
+            for j in range(codes.shape[1]):
+                counts[codes[i,j]] += 1
+            best = 0
+            for c in range(1,n_com):
+                if (counts[c]>counts[best] or (counts[c]==counts[best] and rank[c]<rank[best])):
+                    best = c
+            out_com[i] = best
+            out_cnt[i] = counts[best]
+        return out_com, out_cnt
+
+
+def _majority_order(codes,n_com,rank):
+    """
+    This function applies the majority rule to the rows of the array of
+    community codes and returns the new order of the rows. To rearrange the
+    columns, pass the transposed array. The parameters include:
+    codes: A 2-dimension array of community codes 0..n_com-1.
+    n_com: The number of distinct communities.
+    rank: An array where rank[c] is the position of the community with code c
+    in the ranking list.
+    """
+    if (numba is not None and codes.size*n_com>_NUMBA_MIN_WORK):
+        # Only the highest ranking majority community of each row matters, so with one
+        # community per row the sort gives the new order directly.
+        coms, vals = _row_majority(codes,rank,n_com)
+        return _priority_order(coms,vals,rank)
+    
+    # For each row, the most frequent communities are stored, one chunk of rows at a time.
+    step = max(1, _COUNT_BUDGET//n_com) # Number of rows in each chunk.
+    idx, coms, vals = [], [], []
+    for start in range(0,codes.shape[0],step):
+        counts = _count_matrix(codes[start:start+step],n_com) # Count of each community in each row.
+        chunk_idx, chunk_coms = np.where(counts==counts.max(axis=1,keepdims=True))
+        idx.append(chunk_idx+start)
+        coms.append(chunk_coms)
+        vals.append(counts[chunk_idx,chunk_coms]) # Frequency of the majority community.
+    idx, coms, vals = np.concatenate(idx), np.concatenate(coms), np.concatenate(vals)
+    # Keep only the first occurrence of each row, i.e. its highest priority majority community.
+    sorted_idx = idx[_priority_order(coms,vals,rank)]
+    first = np.unique(sorted_idx, return_index=True)[1]
+    return sorted_idx[np.sort(first)]
+
+
+def _hls_to_rgb(hue,lig,sat):
+    """
+    This function converts arrays of hue, lightness and saturation to an
+    (n, 3) array of RGB colors. It is a vectorized version of
+    colorsys.hls_to_rgb.
+    """
+    m2 = np.where(lig<=0.5, lig*(1.0+sat), lig+sat-lig*sat)
+    m1 = 2.0*lig - m2
+    RGB_color = []
+    for h in (hue+1.0/3, hue, hue-1.0/3):
+        h = h % 1.0
+        RGB_color.append(np.select([h<1.0/6, h<0.5, h<2.0/3],
+                                   [m1+(m2-m1)*h*6.0, m2, m1+(m2-m1)*(2.0/3-h)*6.0],
+                                   default=m1))
+    return np.stack(RGB_color, axis=1)
+
+
+@lru_cache(maxsize=None)
+def _build_palette(n_com):
+    """
+    This function returns an (n_com, 4) uint8 array of RGBA colors, one
+    "distinct" enough color for each community code. The hues are evenly
+    spaced, and the lightness and saturation follow a golden-ratio sequence,
+    so that neighbouring hues rarely get similar colors and the same n_com
+    always gives the same palette.
+    """
+    phi = (np.sqrt(5)-1)/2
+    i = np.arange(n_com)
     
     # Generate n_com "distinct" enough colors.
-    HLS_color = []
-    i = 0
-    step = 0.9/n_com
-    init = step
-    while i < n_com:
-        temp_hue = init
-        temp_lig = rd.random()
-        temp_sat = rd.random()
-        HLS_color.append((temp_hue,temp_lig,temp_sat))
-        i += 1
-        init += step
-    RGB_color = [cs.hls_to_rgb(a,b,c) for (a,b,c) in HLS_color]
+    hue = (i+1)*(0.9/n_com)
+    lig = 0.3 + (i*phi)%0.5
+    sat = 0.5 + (i*phi*phi)%0.4
+    RGB_color = _hls_to_rgb(hue, lig, sat)
     
-    # Prepare the discrete colormap for each integer/community.
-    cmap = colors.ListedColormap(RGB_color)
+    # Convert to 8-bit RGBA so that the plotted data can be colored by a simple lookup.
+    palette = np.empty((n_com,4), dtype=np.uint8)
+    palette[:,:3] = np.round(RGB_color*255)
+    palette[:,3] = round(0.8*255) # The cells are drawn with an alpha of 0.8.
+    palette.flags.writeable = False # The palette is shared through the cache.
+    return palette
+
+
+def _downsample(data,n_com,max_dim=2000):
+    """
+    This function reduces the array of community codes data to at most max_dim
+    rows and columns for plotting. Each block of cells is replaced by its most
+    frequent community. It returns the reduced array together with the row and
+    column edges of the blocks in the coordinates of data.
+    """
+    n_row, n_col = data.shape # Number of rows and columns.
+    bh = -(-n_row//max_dim) # Number of rows in each block.
+    bw = -(-n_col//max_dim) # Number of columns in each block.
+    row_edges = np.append(np.arange(0,n_row,bh), n_row)
+    col_edges = np.append(np.arange(0,n_col,bw), n_col)
+    if (bh==1 and bw==1): # Small enough to be plotted as it is.
+        return data, row_edges, col_edges
+    
+    n_bcol = len(col_edges)-1 # Number of blocks in each band of rows.
+    block_col = (np.arange(n_col)//bw).astype(np.int64)*n_com # Offset of the block of each column.
+    small = np.empty((len(row_edges)-1,n_bcol), dtype=data.dtype)
+    for i in range(len(row_edges)-1):
+        # Count only the (block, community) pairs that occur in this band of rows, so that the
+        # cost does not grow with n_com.
+        pairs, counts = np.unique(data[row_edges[i]:row_edges[i+1],:] + block_col, return_counts=True)
+        blocks = pairs//n_com
+        # For each block, put its most frequent community first (the lowest code among ties).
+        order = np.lexsort((-counts,blocks))
+        first = np.flatnonzero(np.diff(blocks[order], prepend=-1)) # Every block has at least one cell.
+        small[i] = pairs[order[first]]%n_com
+    return small, row_edges, col_edges
+
+
+def _render(data,n_com,rownames,colnames,fname):
+    """
+    This function plots the array of community codes data with the given row
+    and column names and saves the figure to fname. Arrays with more than 2000
+    rows or columns are reduced by _downsample first; their cells are then
+    drawn without edges and the row and column names are left out, as they
+    could not be told apart anyway.
+    """
+    n_row, n_col = data.shape # Number of rows and columns.
+    small, row_edges, col_edges = _downsample(data, n_com)
+    rgba = _build_palette(n_com)[small] # Color each cell by looking up its community code.
     
     # Prepare the plot.
     fig, ax = plt.subplots(figsize=(16,16))
-    xticks = np.arange(0,n_col,1)+0.5
-    yticks = np.arange(0,n_row,1)+0.5
-    ax.set_xticks(xticks, minor=False)
-    ax.set_yticks(yticks, minor=False)
-    ax.pcolor(com_data, cmap=cmap, alpha=0.8, edgecolors='white', linewidths=1)
+    if (small is data):
+        xticks = np.arange(0,n_col,1)+0.5
+        yticks = np.arange(0,n_row,1)+0.5
+        ax.set_xticks(xticks, minor=False)
+        ax.set_yticks(yticks, minor=False)
+        ax.pcolormesh(col_edges, row_edges, rgba, edgecolors='white', linewidths=1)
+    else:
+        ax.pcolormesh(col_edges, row_edges, rgba, edgecolors='none')
     ax.invert_yaxis() # This will make the rows start from the top. 
     ax.xaxis.tick_top() # This will make x labels on top.
-    ax.set_xticklabels(colnames, minor=False)
-    ax.set_yticklabels(rownames, minor=False)
+    if (small is data):
+        ax.set_xticklabels(colnames, minor=False)
+        ax.set_yticklabels(rownames, minor=False)
+    
+    plt.savefig(fname)
+
+
+class _ArrayKey(object):
+    """
+    A hashable key for an array, based on its shape, type and content. It
+    carries the array along so that a cache miss can be computed from it.
+    """
+    def __init__(self,com_data):
+        self.com_data = com_data
+        digest = hashlib.sha1(com_data).hexdigest() # com_data is C-contiguous, see _analyze.
+        self.key = (com_data.shape, com_data.dtype.str, digest)
+    
+    def __hash__(self):
+        return hash(self.key)
+    
+    def __eq__(self,other):
+        return self.key==other.key
+
+
+class _Analysis(object):
+    """
+    The communities of a community array ranked by frequency, together with
+    the majority rule orders of its rows and columns, which are computed on
+    first use. Only these small arrays are kept, so that the cache of _analyze
+    does not keep a copy of the community array alive. All of them are
+    read-only, as they are shared through the cache.
+    """
+    def __init__(self,labels,rank):
+        self.labels = labels
+        self.n_com = len(labels) # Number of distinct communities.
+        self.rank = rank
+        self.labels.flags.writeable = False
+        self.rank.flags.writeable = False
+        self._row_order = None
+        self._col_order = None
     
-    plt.savefig('original.png')
+    def row_order(self,codes):
+        """The new order of the rows of the array of community codes."""
+        if (self._row_order is None):
+            self._row_order = _majority_order(codes,self.n_com,self.rank)
+            self._row_order.flags.writeable = False
+        return self._row_order
+    
+    def col_order(self,codes):
+        """The new order of the columns, computed on a contiguous transposed copy."""
+        if (self._col_order is None):
+            self._col_order = _majority_order(np.ascontiguousarray(codes.T),self.n_com,self.rank)
+            self._col_order.flags.writeable = False
+        return self._col_order
+
+
+@lru_cache(maxsize=4)
+def _cached_analysis(array_key):
+    """
+    This function returns the _Analysis of the array carried by array_key.
+    """
+    analysis = _Analysis(*_rank_communities(array_key.com_data))
+    array_key.com_data = None # The cache does not need to keep the array alive.
+    return analysis
+
+
+def _analyze(com_data):
+    """
+    This function returns the array of community codes of com_data, where
+    codes[i,j] is the code (0..n_com-1) of the community com_data[i,j], and
+    the _Analysis of com_data. The analysis is cached by the content of the
+    array, so that plotting the same array with several of the functions below
+    ranks its communities and applies the majority rule only once. The codes
+    are not cached; when the communities are not already 0..n_com-1, they
+    are looked up again from the sorted labels.
+    """
+    com_data = np.ascontiguousarray(com_data) # Only copies when com_data is not C-contiguous.
+    if not np.issubdtype(com_data.dtype, np.integer):
+        com_data = com_data.astype(np.intp) # Make sure that the communities are denoted as integers.
+    analysis = _cached_analysis(_ArrayKey(com_data))
+    if (analysis.labels[0]==0 and analysis.labels[-1]==analysis.n_com-1):
+        codes = com_data # The communities are already 0..n_com-1, so they are their own codes.
+    else:
+        codes = np.searchsorted(analysis.labels, com_data) # Position of each community in labels.
+    return codes, analysis
+
+
+def plot_com_original(com_data,rownames,colnames):
+    """
+    This function returns a plot of the community array as it is. The parameters
+    include:
+    com_data: A 2-dimension community array. 
+    rownames: A list of strings corresponding to the row names of com_data.
+    colnames: A list of strings corresponding to the column names of com_data.
+    """
+    codes, analysis = _analyze(com_data)
+    _render(codes, analysis.n_com, rownames, colnames, 'original.png')
 
 
 def plot_com_order1(com_data,rownames,colnames,row=True):
@@ -99,106 +353,25 @@ def plot_com_order1(com_data,rownames,colnames,row=True):
     be rearranged and rows will be fixed.
     """
     # Get the basic info of the community array.
-    com_data = com_data.astype(int) # Make sure that the communities are denoted as integers.
-    n_row = np.shape(com_data)[0] # Number of rows.
-    n_col = np.shape(com_data)[1] # Number of columns.
-    data = com_data.reshape(com_data.size) # Convert to 1-dimension array.
-    all_count = np.bincount(data) # Count frequency of each community.
-    all_order = np.argsort(all_count)[::-1] # Generate the ranking list of communities by frequency.
-    n_com = len(all_order) # n_com is equal to the largest integer in com_data plus 1.
+    codes, analysis = _analyze(com_data)
+    n_com = analysis.n_com
     
     # Apply the majority rule depending on the logical value of row.
-    majority = {}
-    for i in range(n_com):
-        majority[i] = {}
-    
     if (row==True): # When rows are to be rearranged.
-        # For each row, the most frequent communities are stored.
-        for i in range(n_row):
-            myrow = com_data[i,:]
-            rowcount = np.bincount(myrow)
-            rowmax = max(rowcount)
-            for (j,k) in enumerate(rowcount):
-                if k==rowmax:
-                    majority[j][i] = k
+        row_order = analysis.row_order(codes) # The new order of the rows.
+        new_data = codes[row_order,:] # The rearranged data.
         
-        unreach = set(range(n_row))
-        row_order = [] # The list of new order of the rows.
-        
-        for i in all_order:
-            if len(majority[i])>0:
-                temp1 = majority[i]
-                temp2 = sorted(temp1.items(), key=operator.itemgetter(1), reverse=True)
-                for (m,n) in temp2:
-                    if (m in unreach):
-                        row_order.append(m)
-                        unreach.remove(m)
-                
-        new_data = com_data[row_order,:] # The rearranged data.    
+        # Reorder the row names.
+        rownames = np.asarray(rownames, dtype=object)[row_order]
+        _render(new_data, n_com, rownames, colnames, 'order1'+'_row.png')
     
     else: # When columns are to be rearranged.
-        # For each column, the most frequent communities are stored.
-        for i in range(n_col):
-            mycol = com_data[:,i]
-            colcount = np.bincount(mycol)
-            colmax = max(colcount)
-            for (j,k) in enumerate(colcount):
-                if k==colmax:
-                    majority[j][i] = k
-        
-        unreach = set(range(n_col))
-        col_order = [] # The list of new order of the columns.
+        col_order = analysis.col_order(codes) # The new order of the columns.
+        new_data = codes[:,col_order] # The rearranged data.
         
-        for i in all_order:
-            if len(majority[i])>0:
-                temp1 = majority[i]
-                temp2 = sorted(temp1.items(), key=operator.itemgetter(1), reverse=True)
-                for (m,n) in temp2:
-                    if (m in unreach):
-                        col_order.append(m)
-                        unreach.remove(m)
-                
-        new_data = com_data[:,col_order] # The rearranged data.  
-    
-    # Generate n_com "distinct" enough colors.
-    HLS_color = []
-    i = 0
-    step = 0.9/n_com
-    init = step
-    while i < n_com:
-        temp_hue = init
-        temp_lig = rd.random()
-        temp_sat = rd.random()
-        HLS_color.append((temp_hue,temp_lig,temp_sat))
-        i += 1
-        init += step
-    RGB_color = [cs.hls_to_rgb(a,b,c) for (a,b,c) in HLS_color]
-
-    # Prepare the discrete colormap for each integer/community.
-    cmap = colors.ListedColormap(RGB_color)
-
-    # Reorder the row names or the column names depending on the logical value of row.
-    if (row==True):
-        rownames = [rownames[i] for i in row_order]
-    else:
-        colnames = [colnames[i] for i in col_order]
-     
-    # Prepare the plot.
-    fig, ax = plt.subplots(figsize=(16,16))
-    xticks = np.arange(0,n_col,1)+0.5
-    yticks = np.arange(0,n_row,1)+0.5
-    ax.set_xticks(xticks, minor=False)
-    ax.set_yticks(yticks, minor=False)
-    ax.pcolor(new_data, cmap=cmap, alpha=0.8, edgecolors='white', linewidths=1)
-    ax.invert_yaxis() # This will make the rows start from the top. 
-    ax.xaxis.tick_top() # This will make x labels on top.
-    ax.set_xticklabels(colnames, minor=False)
-    ax.set_yticklabels(rownames, minor=False)
-    
-    if (row==True):
-        plt.savefig('order1'+'_row.png')
-    else:
-        plt.savefig('order1'+'_col.png')
+        # Reorder the column names.
+        colnames = np.asarray(colnames, dtype=object)[col_order]
+        _render(new_data, n_com, rownames, colnames, 'order1'+'_col.png')
 
 
 def plot_com_order2(com_data,rownames,colnames):
@@ -210,102 +383,18 @@ def plot_com_order2(com_data,rownames,colnames):
     colnames: A list of strings corresponding to the column names of com_data.
     """
     # Get the basic info of the community array.
-    com_data = com_data.astype(int) # Make sure that the communities are denoted as integers.
-    n_row = np.shape(com_data)[0] # Number of rows.
-    n_col = np.shape(com_data)[1] # Number of columns.
-    data = com_data.reshape(com_data.size) # Convert to 1-dimension array.
-    all_count = np.bincount(data) # Count frequency of each community.
-    all_order = np.argsort(all_count)[::-1] # Generate the ranking list of communities by frequency.
-    n_com = len(all_order) # n_com is equal to the largest integer in com_data plus 1.
+    codes, analysis = _analyze(com_data)
+    n_com = analysis.n_com
     
-    # First apply the majority rule to the rows.
-    majority_row = {}
-    for i in range(n_com):
-        majority_row[i] = {}
+    # Apply the majority rule to the rows and to the columns of the original data.
+    row_order = analysis.row_order(codes) # The new order of the rows.
+    col_order = analysis.col_order(codes) # The new order of the columns.
     
-    # For each row, the most frequent communities are stored.
-    for i in range(n_row):
-        myrow = com_data[i,:]
-        rowcount = np.bincount(myrow)
-        rowmax = max(rowcount)
-        for (j,k) in enumerate(rowcount):
-            if k==rowmax:
-                majority_row[j][i] = k
-        
-    unreach = set(range(n_row))
-    row_order = [] # The list of new order of the rows.
-        
-    for i in all_order:
-        if len(majority_row[i])>0:
-            temp1 = majority_row[i]
-            temp2 = sorted(temp1.items(), key=operator.itemgetter(1), reverse=True)
-            for (m,n) in temp2:
-                if (m in unreach):
-                    row_order.append(m)
-                    unreach.remove(m)
-                
-    new_data = com_data[row_order,:] # The row-rearranged data.    
-    
-    # Then apply the majority rule to the columns.
-    majority_col = {}
-    for i in range(n_com):
-        majority_col[i] = {}
-
-    # For each column, the most frequent communities are stored.
-    for i in range(n_col):
-        mycol = com_data[:,i]
-        colcount = np.bincount(mycol)
-        colmax = max(colcount)
-        for (j,k) in enumerate(colcount):
-            if k==colmax:
-                majority_col[j][i] = k
-        
-    unreach = set(range(n_col))
-    col_order = [] # The list of new order of the columns.
-        
-    for i in all_order:
-        if len(majority_col[i])>0:
-            temp1 = majority_col[i]
-            temp2 = sorted(temp1.items(), key=operator.itemgetter(1), reverse=True)
-            for (m,n) in temp2:
-                if (m in unreach):
-                    col_order.append(m)
-                    unreach.remove(m)
-                
-    new_data2 = new_data[:,col_order] # The row-and-column-rearranged data.  
-    
-    # Generate n_com "distinct" enough colors.
-    HLS_color = []
-    i = 0
-    step = 0.9/n_com
-    init = step
-    while i < n_com:
-        temp_hue = init
-        temp_lig = rd.random()
-        temp_sat = rd.random()
-        HLS_color.append((temp_hue,temp_lig,temp_sat))
-        i += 1
-        init += step
-    RGB_color = [cs.hls_to_rgb(a,b,c) for (a,b,c) in HLS_color]
-    
-    # Prepare the discrete colormap for each integer/community.
-    cmap = colors.ListedColormap(RGB_color)
+    # Apply both orders in a single gather.
+    new_data2 = codes[np.ix_(row_order,col_order)] # The row-and-column-rearranged data.
     
     # Reorder the row names and the column names.
-    rownames = [rownames[i] for i in row_order]
-    colnames = [colnames[i] for i in col_order]
+    rownames = np.asarray(rownames, dtype=object)[row_order]
+    colnames = np.asarray(colnames, dtype=object)[col_order]
     
-    # Prepare the plot.
-    fig, ax = plt.subplots(figsize=(16,16))
-    xticks = np.arange(0,n_col,1)+0.5
-    yticks = np.arange(0,n_row,1)+0.5
-    ax.set_xticks(xticks, minor=False)
-    ax.set_yticks(yticks, minor=False)
-    ax.pcolor(new_data2, cmap=cmap, alpha=0.8, edgecolors='white', linewidths=1)
-    ax.invert_yaxis() # This will make the rows start from the top. 
-    ax.xaxis.tick_top() # This will make x labels on top.
-    ax.set_xticklabels(colnames, minor=False)
-    ax.set_yticklabels(rownames, minor=False)
-    
-    plt.savefig('order2.png')
-
+    _render(new_data2, n_com, rownames, colnames, 'order2.png')
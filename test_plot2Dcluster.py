@@ -0,0 +1,36 @@
+import pytest
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import plot2Dcluster as p2c
+
+
+def test_downsample_with_many_communities():
+    # Almost every cell is its own community, so counting all n_com per block would not fit in memory.
+    n_row, n_col = 2003, 4001
+    n_com = n_row*n_col
+    rs = np.random.RandomState(0)
+    data = rs.permutation(n_com).reshape(n_row,n_col)
+    data[:10,:4] = 7 # One block dominated by a single community.
+    small, row_edges, col_edges = p2c._downsample(data, n_com)
+    assert small.shape == (len(row_edges)-1, len(col_edges)-1)
+    assert max(small.shape) <= 2000
+    assert small[0,0] == 7
+    # Without a majority, the lowest code of the block wins.
+    assert small[-1,-1] == data[row_edges[-2]:,col_edges[-2]:].min()
+
+
+def test_numba_majority_order_matches_numpy(monkeypatch):
+    pytest.importorskip('numba')
+    rs = np.random.RandomState(0)
+    for t in range(50):
+        # Few communities and short rows, so that many rows have tied majorities.
+        data = rs.randint(0, 4, (rs.randint(1,12), rs.randint(1,12)))
+        codes, analysis = p2c._analyze(data)
+        for arr in (codes, np.ascontiguousarray(codes.T)):
+            monkeypatch.setattr(p2c, '_NUMBA_MIN_WORK', -1)
+            with_numba = p2c._majority_order(arr, analysis.n_com, analysis.rank)
+            monkeypatch.setattr(p2c, 'numba', None)
+            with_numpy = p2c._majority_order(arr, analysis.n_com, analysis.rank)
+            monkeypatch.undo()
+            assert np.array_equal(with_numba, with_numpy)